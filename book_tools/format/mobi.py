@@ -10,15 +10,15 @@ from book_tools.format.mimetype import Mimetype
 class Mobipocket(BookFile):
     def __init__(self, file, original_filename):
         BookFile.__init__(self, file, original_filename, Mimetype.MOBI)
-        bm = BookMobi(file)
-        self._encryption_method = bm["encryption"]
-        self.__set_title__(bm["title"])
-        self.__add_author__(bm["author"])
-        self.__set_docdate__(bm["modificationDate"].strftime("%Y-%m-%d"))
-        if bm["subject"]:
-            for tag in bm["subject"]:
-                self.__add_tag__(tag)
-        self.description = bm["description"]
+        with BookMobi(file) as bm:
+            self._encryption_method = bm["encryption"]
+            self.__set_title__(bm["title"])
+            self.__add_author__(bm["author"])
+            self.__set_docdate__(bm["modificationDate"].strftime("%Y-%m-%d"))
+            if bm["subject"]:
+                for tag in bm["subject"]:
+                    self.__add_tag__(tag)
+            self.description = bm["description"]
 
     def __exit__(self, kind, value, traceback):
         pass
@@ -32,7 +32,8 @@ class Mobipocket(BookFile):
 
     def extract_cover_internal(self, working_dir):
         tmp_dir = mkdtemp(dir=working_dir)
-        BookMobi(self.file).unpackMobi(tmp_dir + "/bookmobi")
+        with BookMobi(self.file) as bm:
+            bm.unpackMobi(tmp_dir + "/bookmobi")
         try:
             if os.path.isfile(tmp_dir + "/bookmobi_cover.jpg"):
                 shutil.copy(tmp_dir + "/bookmobi_cover.jpg", working_dir)
@@ -44,7 +45,8 @@ class Mobipocket(BookFile):
 
     def extract_cover_memory(self):
         try:
-            image = BookMobi(self.file).unpackMobiCover()
+            with BookMobi(self.file) as bm:
+                image = bm.unpackMobiCover()
         except Exception as err:
             print(err)
             image = None
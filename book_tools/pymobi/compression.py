@@ -1,5 +1,24 @@
 import struct
 
+np = None
+jit = None
+
+
+def loadJit():
+    # numba takes a while to import, so the accelerated decoders are only
+    # loaded once a book is actually unpacked; False when it is not installed
+    global np, jit
+    if jit is None:
+        try:
+            import numpy
+            from book_tools.pymobi import jit as module
+        except ImportError:
+            module = False
+        else:
+            np = numpy
+        jit = module
+    return jit
+
 
 class Uncompression(object):
     def pack(self, data):
@@ -14,61 +33,45 @@ class Palmdoc(object):
         raise ValueError("not implement")
 
     def unpack(self, i):
-        o, p = "", 0
-        while p < len(i):
-            c = ord(i[p])
-            p += 1
-            if c >= 1 and c <= 8:
-                o += i[p : p + c]
-                p += c
-            elif c < 128:
-                o += chr(c)
-            elif c >= 192:
-                o += " " + chr(c ^ 128)
-            else:
-                if p < len(i):
-                    c = (c << 8) | ord(i[p])
-                    p += 1
-                    m = (c >> 3) & 0x07FF
-                    n = (c & 7) + 3
-                    if m > n:
-                        o += o[-m : n - m]
-                    else:
-                        for z in range(n):
-                            o += o[-m]
-        return o
+        if not loadJit():
+            return self.unpackPython(i)
+        out, size = jit.palmdoc_decode(np.frombuffer(i, np.uint8))
+        return out[:size].tobytes()
 
-    def unpack3(self, i):
-        o, p = b"", 0
+    def unpackPython(self, i):
+        o, p = bytearray(), 0
         while p < len(i):
             c = i[p]
             p += 1
             if c >= 1 and c <= 8:
-                o += i[p : p + c]
+                o.extend(i[p : p + c])
                 p += c
             elif c < 128:
-                o += c.to_bytes(1, "big")
+                o.append(c)
             elif c >= 192:
-                o += b" " + (c ^ 128).to_bytes(1, "big")
+                o += b" "
+                o.append(c ^ 128)
             else:
                 if p < len(i):
                     c = (c << 8) | i[p]
                     p += 1
                     m = (c >> 3) & 0x07FF
                     n = (c & 7) + 3
+                    if m > len(o) or m == 0:
+                        raise ValueError("invalid palmdoc back-reference")
                     if m > n:
-                        o += o[-m : n - m]
+                        o.extend(o[-m : n - m])
                     else:
                         for z in range(n):
-                            o += o[-m].to_bytes(1, "big")
-        return o
+                            o.append(o[-m])
+        return bytes(o)
 
 
 class Huffcdic(object):
     q = struct.Struct(">Q").unpack_from
 
     def loadHuff(self, huff):
-        if huff[0:8] != "HUFF\x00\x00\x00\x18":
+        if huff[0:8] != b"HUFF\x00\x00\x00\x18":
             raise ValueError("invalid huff header")
         off1, off2 = struct.unpack_from(">LL", huff, 8)
 
@@ -80,19 +83,38 @@ class Huffcdic(object):
             maxcode = ((maxcode + 1) << (32 - codelen)) - 1
             return (codelen, term, maxcode)
 
-        self.dict1 = map(dict1_unpack, struct.unpack_from(">256L", huff, off1))
+        self.dict1 = tuple(map(dict1_unpack, struct.unpack_from(">256L", huff, off1)))
 
         dict2 = struct.unpack_from(">64L", huff, off2)
-        self.mincode, self.maxcode = (), ()
-        for codelen, mincode in enumerate((0,) + dict2[0::2]):
-            self.mincode += (mincode << (32 - codelen),)
-        for codelen, maxcode in enumerate((0,) + dict2[1::2]):
-            self.maxcode += (((maxcode + 1) << (32 - codelen)) - 1,)
+        self.mincode = tuple(
+            [
+                mincode << (32 - codelen)
+                for codelen, mincode in enumerate((0,) + dict2[0::2])
+            ]
+        )
+        self.maxcode = tuple(
+            [
+                ((maxcode + 1) << (32 - codelen)) - 1
+                for codelen, maxcode in enumerate((0,) + dict2[1::2])
+            ]
+        )
 
         self.dictionary = []
+        self.tables = None
+        if loadJit():
+            # per top code byte: code length, terminal flag and maxcode, so
+            # short codes are resolved with two table loads and a shift
+            self.tables = (
+                np.array([v[0] for v in self.dict1], np.uint8),
+                np.array([1 if v[1] else 0 for v in self.dict1], np.uint8),
+                np.array([v[2] for v in self.dict1], np.int64),
+                np.array(self.mincode + (0,), np.int64),
+                np.array(self.maxcode + (0,), np.int64),
+            )
+        self.phrases = None
 
     def loadCdic(self, cdic):
-        if cdic[0:8] != "CDIC\x00\x00\x00\x10":
+        if cdic[0:8] != b"CDIC\x00\x00\x00\x10":
             raise ValueError("invalid cdic header")
         phrases, bits = struct.unpack_from(">LL", cdic, 8)
         n = min(1 << bits, phrases - len(self.dictionary))
@@ -104,20 +126,68 @@ class Huffcdic(object):
             return (slice, blen & 0x8000)
 
         self.dictionary += map(getslice, struct.unpack_from(">%dH" % n, cdic, 16))
+        self.phrases = None
+
+    def loadPhrases(self):
+        # literal phrases are used in place, compressed ones are expanded by
+        # jit.huff_resolve; a broken phrase only fails the records using it,
+        # the same way as in unpackPython
+        slices = [slice for slice, flag in self.dictionary]
+        phr_len = np.array([len(slice) for slice in slices], np.int64)
+        phr_off = np.zeros(len(slices), np.int64)
+        np.cumsum(phr_len[:-1], out=phr_off[1:])
+        phr_data = np.frombuffer(b"".join(slices), np.uint8)
+        exp_data = np.empty(max(4096, 2 * len(phr_data)), np.uint8)
+        exp_data[: len(phr_data)] = phr_data
+        state = np.array(
+            [jit.HUFF_EXPANDED if flag else 0 for slice, flag in self.dictionary],
+            np.uint8,
+        )
+        self.phrases = jit.huff_resolve(
+            *self.tables,
+            phr_data,
+            phr_off,
+            phr_len,
+            exp_data,
+            len(phr_data),
+            phr_off.copy(),
+            phr_len.copy(),
+            state,
+        )
 
     def pack(self, i):
         raise ValueError("not implement")
 
     def unpack(self, data):
+        if self.tables is None:
+            return self.unpackPython(data)
+        if self.phrases is None:
+            self.loadPhrases()
+        words = np.frombuffer(
+            data + b"\x00" * (8 + -len(data) % 4), np.dtype(">u4")
+        ).astype(np.int64)
+        status, out, size = jit.huff_decode(
+            words, len(data) * 8, *self.tables, *self.phrases
+        )
+        if status < 0:
+            # the phrase could not be expanded, state holds the reason
+            status = self.phrases[3][-status - 1]
+        if status:
+            raise ValueError(jit.huff_errors[status])
+        return out[:size].tobytes()
+
+    def symbols(self, data):
+        # yield the dictionary index of every code in data
         q = Huffcdic.q
+        dict1, mincode, maxcodes = self.dict1, self.mincode, self.maxcode
+        nphrases = len(self.dictionary)
 
         bitsleft = len(data) * 8
-        data += "\x00\x00\x00\x00\x00\x00\x00\x00"
+        data += b"\x00\x00\x00\x00\x00\x00\x00\x00"
         pos = 0
         (x,) = q(data, pos)
         n = 32
 
-        s = ""
         while True:
             if n <= 0:
                 pos += 4
@@ -125,11 +195,13 @@ class Huffcdic(object):
                 n += 32
             code = (x >> n) & ((1 << 32) - 1)
 
-            codelen, term, maxcode = self.dict1[code >> 24]
+            codelen, term, maxcode = dict1[code >> 24]
             if not term:
-                while code < self.mincode[codelen]:
+                while code < mincode[codelen]:
                     codelen += 1
-                maxcode = self.maxcode[codelen]
+                    if codelen > 32:
+                        raise ValueError("invalid huff code")
+                maxcode = maxcodes[codelen]
 
             n -= codelen
             bitsleft -= codelen
@@ -137,10 +209,41 @@ class Huffcdic(object):
                 break
 
             r = (maxcode - code) >> (32 - codelen)
-            slice, flag = self.dictionary[r]
+            if r < 0 or r >= nphrases:
+                raise ValueError("invalid huff/cdic phrase index")
+            yield r
+
+    def unpackPython(self, data):
+        dictionary = self.dictionary
+        s = bytearray()
+        for r in self.symbols(data):
+            slice, flag = dictionary[r]
             if not flag:
-                self.dictionary[r] = None
-                slice = self.unpack(slice)
-                self.dictionary[r] = (slice, 1)
+                slice = self.resolvePhrase(r)
             s += slice
-        return s
+        return bytes(s)
+
+    def resolvePhrase(self, r):
+        # expand compressed phrase r and the phrases it refers to with an
+        # explicit stack, each one is stored back resolved and decoded once
+        dictionary = self.dictionary
+        pending = {r}
+        stack = [(r, self.symbols(dictionary[r][0]), bytearray())]
+        while True:
+            r, symbols, s = stack[-1]
+            for sub in symbols:
+                slice, flag = dictionary[sub]
+                if not flag:
+                    if sub in pending:
+                        raise ValueError("recursive huff/cdic phrase")
+                    pending.add(sub)
+                    stack.append((sub, self.symbols(slice), bytearray()))
+                    break
+                s += slice
+            else:
+                stack.pop()
+                slice = bytes(s)
+                dictionary[r] = (slice, 1)
+                if not stack:
+                    return slice
+                stack[-1][2].extend(slice)
@@ -0,0 +1,198 @@
+"""numba versions of the palmdoc and huff/cdic decoders
+
+Importing this module requires numpy and numba, compression.loadJit() does
+it on the first unpack and falls back to the pure python decoders when they
+are not installed.
+"""
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, nogil=True)
+def palmdoc_decode(i):
+    # a command expands to at most 5 times its own size
+    out = np.empty(5 * len(i) + 8, np.uint8)
+    size, p = 0, 0
+    while p < len(i):
+        c = i[p]
+        p += 1
+        if c >= 1 and c <= 8:
+            c = min(c, len(i) - p)
+            out[size : size + c] = i[p : p + c]
+            size += c
+            p += c
+        elif c < 128:
+            out[size] = c
+            size += 1
+        elif c >= 192:
+            out[size] = 32
+            out[size + 1] = c ^ 128
+            size += 2
+        else:
+            if p < len(i):
+                c = (np.int64(c) << 8) | i[p]
+                p += 1
+                m = (c >> 3) & 0x07FF
+                n = (c & 7) + 3
+                if m > size or m == 0:
+                    raise ValueError("invalid palmdoc back-reference")
+                # byte by byte, the source may overlap the output
+                for z in range(n):
+                    out[size] = out[size - m]
+                    size += 1
+    return out, size
+
+
+@njit(cache=True, nogil=True)
+def huff_words(buf, lo, length):
+    # big-endian 32-bit words of buf[lo:lo+length], zero padded so that
+    # the decoder may always read two words ahead
+    nw = (length + 3) // 4 + 2
+    words = np.zeros(nw, np.int64)
+    for k in range(length):
+        words[k >> 2] |= np.int64(buf[lo + k]) << (24 - 8 * (k & 3))
+    return words
+
+
+# values of the phrase state array; the error codes are also returned by
+# huff_decode and are looked up in huff_errors
+HUFF_PENDING = 1
+HUFF_EXPANDED = 2
+HUFF_RECURSIVE = 3
+HUFF_BAD_CODE = 4
+HUFF_BAD_INDEX = 5
+huff_errors = {
+    HUFF_RECURSIVE: "recursive huff/cdic phrase",
+    HUFF_BAD_CODE: "invalid huff code",
+    HUFF_BAD_INDEX: "invalid huff/cdic phrase index",
+}
+
+
+@njit(cache=True, nogil=True)
+def huff_decode(
+    words,
+    bitsleft,
+    dict1_cl,
+    dict1_tm,
+    dict1_mc,
+    mincode,
+    maxcode,
+    exp_data,
+    exp_off,
+    exp_len,
+    state,
+):
+    # returns (0, out, size) on success, (error, out, size) on a broken
+    # code, or (-(r + 1), out, size) when phrase r is not expanded
+    size = 0
+    out = np.empty(max(64, len(words) * 16), np.uint8)
+    nphrases = len(state)
+    pos = 0
+    n = 32
+    while True:
+        if n <= 0:
+            pos += 1
+            n += 32
+        code = ((words[pos] << (32 - n)) | (words[pos + 1] >> n)) & 0xFFFFFFFF
+
+        t = code >> 24
+        codelen = dict1_cl[t]
+        if dict1_tm[t]:
+            mc = dict1_mc[t]
+        else:
+            while code < mincode[codelen]:
+                codelen += 1
+            if codelen > 32:
+                return HUFF_BAD_CODE, out, size
+            mc = maxcode[codelen]
+
+        n -= codelen
+        bitsleft -= codelen
+        if bitsleft < 0:
+            break
+
+        r = (mc - code) >> (32 - codelen)
+        if r < 0 or r >= nphrases:
+            return HUFF_BAD_INDEX, out, size
+        if state[r] != HUFF_EXPANDED:
+            return -(r + 1), out, size
+        lo = exp_off[r]
+        ln = exp_len[r]
+        if size + ln > len(out):
+            grown = np.empty(max(2 * len(out), size + ln), np.uint8)
+            grown[:size] = out[:size]
+            out = grown
+        for k in range(ln):
+            out[size + k] = exp_data[lo + k]
+        size += ln
+    return 0, out, size
+
+
+@njit(cache=True, nogil=True)
+def huff_resolve(
+    dict1_cl,
+    dict1_tm,
+    dict1_mc,
+    mincode,
+    maxcode,
+    phr_data,
+    phr_off,
+    phr_len,
+    exp_data,
+    used,
+    exp_off,
+    exp_len,
+    state,
+):
+    # expand every compressed phrase once, innermost first, using an
+    # explicit stack instead of recursion. A phrase that cannot be expanded
+    # keeps its error code in state, so like unpackPython it only fails the
+    # records that use it. Called before the records are unpacked, so the
+    # arrays are read-only while huff_decode runs in several threads.
+    stack = np.empty(len(state), np.int64)
+    for r0 in range(len(state)):
+        if state[r0] != 0:
+            continue
+        stack[0] = r0
+        state[r0] = HUFF_PENDING
+        sp = 1
+        while sp:
+            r = stack[sp - 1]
+            words = huff_words(phr_data, phr_off[r], phr_len[r])
+            status, out, size = huff_decode(
+                words,
+                phr_len[r] * 8,
+                dict1_cl,
+                dict1_tm,
+                dict1_mc,
+                mincode,
+                maxcode,
+                exp_data,
+                exp_off,
+                exp_len,
+                state,
+            )
+            if status < 0:
+                s = -status - 1
+                if state[s] == 0:
+                    state[s] = HUFF_PENDING
+                    stack[sp] = s
+                    sp += 1
+                    continue
+                # s is further down the stack, or could not be expanded
+                status = HUFF_RECURSIVE if state[s] == HUFF_PENDING else state[s]
+            if status:
+                state[r] = status
+            else:
+                if used + size > len(exp_data):
+                    grown = np.empty(max(2 * len(exp_data), used + size), np.uint8)
+                    grown[:used] = exp_data[:used]
+                    exp_data = grown
+                exp_data[used : used + size] = out[:size]
+                exp_off[r] = used
+                exp_len[r] = size
+                state[r] = HUFF_EXPANDED
+                used += size
+            sp -= 1
+    return exp_data[:used], exp_off, exp_len, state
@@ -1,14 +1,13 @@
 import os.path
+import array
 import datetime
+import mmap
 import struct
 import re
-import array
 import sys
-
-try:
-    from collections import OrderedDict
-except:
-    from ordereddict import OrderedDict
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 from book_tools.pymobi.util import hexdump, decodeVarint, toStr, toByte
 from book_tools.pymobi import compression
@@ -138,6 +137,51 @@ mobi_exth_type = {
     529: "kindlegen version",
     535: "Creator Build Number",
 }
+img_regex = re.compile(
+    rb"""<img\s+(?:recindex=['"](?P<r>\d+)['"]"""
+    rb"""|src=['"]kindle:embed:(?P<k>\d+)\?mime=image/jpg['"])""",
+    re.I,
+)
+head_regex = re.compile(rb"<head>", re.I)
+# array typecode of a 4-byte unsigned integer, "I" on most platforms
+uint32_typecode = next((t for t in "IL" if array.array(t).itemsize == 4), None)
+image_magic = {
+    b"GIF8": ".gif",
+    b"\x89PNG": ".png",
+}
+
+
+class ExthRecords(Mapping):
+    """
+    EXTH records keyed by record type.
+
+    Only the position of each value inside record0 is kept while parsing,
+    values are sliced out and cached the first time they are read.
+    """
+
+    def __init__(self, record0=b""):
+        self.record0 = record0
+        self.index = {}
+        self.cache = {}
+
+    def add(self, recordType, offset, length):
+        self.index[recordType] = (offset, length)
+        self.cache.pop(recordType, None)
+
+    def __getitem__(self, recordType):
+        if recordType not in self.cache:
+            offset, length = self.index[recordType]
+            self.cache[recordType] = self.record0[offset : offset + length]
+        return self.cache[recordType]
+
+    def __contains__(self, recordType):
+        return recordType in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
 
 
 class BookMobi(object):
@@ -167,116 +211,129 @@ class BookMobi(object):
     """
 
     palmdb_format = [
-        ("name", "32s", 0),
-        ("attributes", ">H", 32),
-        ("version", ">H", 34),
-        ("creationDate", ">L", 36),
-        ("modificationDate", ">L", 40),
-        ("lastbackupDate", ">L", 44),
-        ("modificationNumber", ">L", 48),
-        ("appInfoID", ">L", 52),
-        ("sortInfoID", ">L", 56),
-        ("type", "4s", 60),
-        ("creator", "4s", 64),
-        ("uniqueIDseed", ">L", 68),
-        ("nextRecordListID", ">L", 72),
-        ("numberOfRecords", ">H", 76),
+        ("name", struct.Struct("32s").unpack_from, 0),
+        ("attributes", struct.Struct(">H").unpack_from, 32),
+        ("version", struct.Struct(">H").unpack_from, 34),
+        ("creationDate", struct.Struct(">L").unpack_from, 36),
+        ("modificationDate", struct.Struct(">L").unpack_from, 40),
+        ("lastbackupDate", struct.Struct(">L").unpack_from, 44),
+        ("modificationNumber", struct.Struct(">L").unpack_from, 48),
+        ("appInfoID", struct.Struct(">L").unpack_from, 52),
+        ("sortInfoID", struct.Struct(">L").unpack_from, 56),
+        ("type", struct.Struct("4s").unpack_from, 60),
+        ("creator", struct.Struct("4s").unpack_from, 64),
+        ("uniqueIDseed", struct.Struct(">L").unpack_from, 68),
+        ("nextRecordListID", struct.Struct(">L").unpack_from, 72),
+        ("numberOfRecords", struct.Struct(">H").unpack_from, 76),
         # recordInfoList = 8 * numberOfRecords ...
     ]
     palmdoc_format = [
-        ("compression", ">H", 0),
-        ("unused", ">H", 2),
-        ("textLength", ">L", 4),
-        ("recordCount", ">H", 8),
-        ("recordSize", ">L", 10),
-        ("currentPosition", ">L", 12),
-        ("encryptionType", ">H", 12),
+        ("compression", struct.Struct(">H").unpack_from, 0),
+        ("unused", struct.Struct(">H").unpack_from, 2),
+        ("textLength", struct.Struct(">L").unpack_from, 4),
+        ("recordCount", struct.Struct(">H").unpack_from, 8),
+        ("recordSize", struct.Struct(">L").unpack_from, 10),
+        ("currentPosition", struct.Struct(">L").unpack_from, 12),
+        ("encryptionType", struct.Struct(">H").unpack_from, 12),
     ]
     mobi_format = [
-        ("identifier", "4s", 16),
-        ("headerLength", ">L", 20),
-        ("mobiType", ">L", 24),
-        ("textEncoding", ">L", 28),
-        ("uniqueID", ">L", 32),
-        ("fileVersion", ">L", 36),
-        ("ortographicIndex", ">L", 40),
-        ("inflectionIndex", ">L", 44),
-        ("indexNames", ">L", 48),
-        ("indexKeys", ">L", 52),
-        ("extraIndex0", ">L", 56),
-        ("extraIndex1", ">L", 60),
-        ("extraIndex2", ">L", 64),
-        ("extraIndex3", ">L", 68),
-        ("extraIndex4", ">L", 72),
-        ("extraIndex5", ">L", 76),
-        ("firstNonBookIndex", ">L", 80),
-        ("fullNameOffset", ">L", 84),
-        ("fullNameLength", ">L", 88),
-        ("locale", ">L", 92),
-        ("inputLanguage", ">L", 96),
-        ("outputLanguage", ">L", 100),
-        ("minVersion", ">L", 104),
-        ("firstImageIndex", ">L", 108),
-        ("huffmanRecordOffset", ">L", 112),
-        ("huffmanRecordCount", ">L", 116),
-        ("huffmanTableOffset", ">L", 120),
-        ("huffmanTableLength", ">L", 124),
-        ("exthFlags", ">L", 128),
-        ("unknown132", "12s", 132),
-        ("unknown144", "16s", 144),
-        ("unknown160", ">L", 160),
-        ("unknown164", ">L", 164),
-        ("drmOffset", ">L", 168),
-        ("drmCount", ">L", 172),
-        ("drmSize", ">L", 176),
-        ("drmFlags", ">L", 180),
-        ("unknown184", ">Q", 184),
-        ("firstContentRecordNumber", ">H", 192),
-        ("lastContentRecordNumber", ">H", 194),
-        ("unknown196", ">L", 196),
-        ("fcisRecordNumber", ">L", 200),
-        ("fcisRecordCount", ">L", 204),
-        ("flisRecordNumber", ">L", 208),
-        ("flisRecordCount", ">L", 212),
-        ("unknown216", "8s", 216),
-        ("srcsRecordNumber", ">L", 224),
-        ("srcsRecordCount", ">L", 228),
-        ("numberOfCompilationDataSections", ">L", 232),
-        ("unknown236", ">L", 236),
-        ("extraRecordDataFlags", ">L", 240),
-        ("indxRecordOffset", ">L", 244),
-        ("unknown248", ">L", 248),
-        ("unknown252", ">L", 252),
+        ("identifier", struct.Struct("4s").unpack_from, 16),
+        ("headerLength", struct.Struct(">L").unpack_from, 20),
+        ("mobiType", struct.Struct(">L").unpack_from, 24),
+        ("textEncoding", struct.Struct(">L").unpack_from, 28),
+        ("uniqueID", struct.Struct(">L").unpack_from, 32),
+        ("fileVersion", struct.Struct(">L").unpack_from, 36),
+        ("ortographicIndex", struct.Struct(">L").unpack_from, 40),
+        ("inflectionIndex", struct.Struct(">L").unpack_from, 44),
+        ("indexNames", struct.Struct(">L").unpack_from, 48),
+        ("indexKeys", struct.Struct(">L").unpack_from, 52),
+        ("extraIndex0", struct.Struct(">L").unpack_from, 56),
+        ("extraIndex1", struct.Struct(">L").unpack_from, 60),
+        ("extraIndex2", struct.Struct(">L").unpack_from, 64),
+        ("extraIndex3", struct.Struct(">L").unpack_from, 68),
+        ("extraIndex4", struct.Struct(">L").unpack_from, 72),
+        ("extraIndex5", struct.Struct(">L").unpack_from, 76),
+        ("firstNonBookIndex", struct.Struct(">L").unpack_from, 80),
+        ("fullNameOffset", struct.Struct(">L").unpack_from, 84),
+        ("fullNameLength", struct.Struct(">L").unpack_from, 88),
+        ("locale", struct.Struct(">L").unpack_from, 92),
+        ("inputLanguage", struct.Struct(">L").unpack_from, 96),
+        ("outputLanguage", struct.Struct(">L").unpack_from, 100),
+        ("minVersion", struct.Struct(">L").unpack_from, 104),
+        ("firstImageIndex", struct.Struct(">L").unpack_from, 108),
+        ("huffmanRecordOffset", struct.Struct(">L").unpack_from, 112),
+        ("huffmanRecordCount", struct.Struct(">L").unpack_from, 116),
+        ("huffmanTableOffset", struct.Struct(">L").unpack_from, 120),
+        ("huffmanTableLength", struct.Struct(">L").unpack_from, 124),
+        ("exthFlags", struct.Struct(">L").unpack_from, 128),
+        ("unknown132", struct.Struct("12s").unpack_from, 132),
+        ("unknown144", struct.Struct("16s").unpack_from, 144),
+        ("unknown160", struct.Struct(">L").unpack_from, 160),
+        ("unknown164", struct.Struct(">L").unpack_from, 164),
+        ("drmOffset", struct.Struct(">L").unpack_from, 168),
+        ("drmCount", struct.Struct(">L").unpack_from, 172),
+        ("drmSize", struct.Struct(">L").unpack_from, 176),
+        ("drmFlags", struct.Struct(">L").unpack_from, 180),
+        ("unknown184", struct.Struct(">Q").unpack_from, 184),
+        ("firstContentRecordNumber", struct.Struct(">H").unpack_from, 192),
+        ("lastContentRecordNumber", struct.Struct(">H").unpack_from, 194),
+        ("unknown196", struct.Struct(">L").unpack_from, 196),
+        ("fcisRecordNumber", struct.Struct(">L").unpack_from, 200),
+        ("fcisRecordCount", struct.Struct(">L").unpack_from, 204),
+        ("flisRecordNumber", struct.Struct(">L").unpack_from, 208),
+        ("flisRecordCount", struct.Struct(">L").unpack_from, 212),
+        ("unknown216", struct.Struct("8s").unpack_from, 216),
+        ("srcsRecordNumber", struct.Struct(">L").unpack_from, 224),
+        ("srcsRecordCount", struct.Struct(">L").unpack_from, 228),
+        ("numberOfCompilationDataSections", struct.Struct(">L").unpack_from, 232),
+        ("unknown236", struct.Struct(">L").unpack_from, 236),
+        ("extraRecordDataFlags", struct.Struct(">L").unpack_from, 240),
+        ("indxRecordOffset", struct.Struct(">L").unpack_from, 244),
+        ("unknown248", struct.Struct(">L").unpack_from, 248),
+        ("unknown252", struct.Struct(">L").unpack_from, 252),
     ]
-    header = OrderedDict()
-    records = OrderedDict()
-    palmdoc = OrderedDict()
-    mobi = OrderedDict()
-    mobi_exth = OrderedDict()
-    book = OrderedDict()
     compression = None
+    # threads used to unpack text records, None for one per cpu
+    workers = None
 
     def __init__(self, file):
+        self.header = {}
+        self.record_offsets = ()
+        self.palmdoc = {}
+        self.mobi = {}
+        self.mobi_exth = ExthRecords()
+        self.book = {}
         if isinstance(file, str):
             f = open(file, "rb")
+            self.owns_file = True
         else:
             f = file
+            self.owns_file = False
 
         self.f = f
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # in-memory or empty files are read with seek/read
+            self.mm = None
         self.f.seek(0, 0)
         # palm database header
         header = f.read(78)
-        for key, u_fmt, offset in self.palmdb_format:
-            (value,) = struct.unpack_from(u_fmt, header, offset)
+        for key, unpack_from, offset in self.palmdb_format:
+            (value,) = unpack_from(header, offset)
             self.header[key] = value
         # palm database record
         f.seek(78)
         records = f.read(self.header["numberOfRecords"] * 8)
-        for count in range(0, self.header["numberOfRecords"]):
-            offset, value = struct.unpack_from(">LL", records, count * 8)
-            attributes = value & 0xFF000000
-            uniqueID = value & 0xFFFFFF
-            self.records[count] = (offset, attributes, uniqueID)
+        # big-endian uint32 (offset, attributes/uniqueID) pairs, converted in
+        # bulk; only the offsets are used
+        if uint32_typecode is not None:
+            record_info = array.array(uint32_typecode, records)
+            if sys.byteorder == "little":
+                record_info.byteswap()
+        else:
+            record_info = struct.unpack(">%dL" % (len(records) // 4), records)
+        self.record_offsets = record_info[0::2]
         ident = "%s%s" % (toStr(self.header["type"]), toStr(self.header["creator"]))
         self.book["title"] = toStr(self.header["name"])
         self.book["ident"] = ident
@@ -288,8 +345,8 @@ class BookMobi(object):
         record0 = self.loadRecord(0)
         if self.isPalmdoc() or self.isMobipocket():
             # palmdoc header
-            for key, u_fmt, offset in self.palmdoc_format:
-                (value,) = struct.unpack_from(u_fmt, record0, offset)
+            for key, unpack_from, offset in self.palmdoc_format:
+                (value,) = unpack_from(record0, offset)
                 self.palmdoc[key] = value
             if self.palmdoc["encryptionType"] == 1:
                 (self.palmdoc["type1KeyData"],) = struct.unpack_from(
@@ -308,10 +365,10 @@ class BookMobi(object):
         if ident == pd_file_code["MobiPocket"]:
             # mobi header
             record0_length = len(record0)
-            for key, u_fmt, offset in self.mobi_format:
+            for key, unpack_from, offset in self.mobi_format:
                 if record0_length < offset:
                     break
-                (value,) = struct.unpack_from(u_fmt, record0, offset)
+                (value,) = unpack_from(record0, offset)
                 self.mobi[key] = value
             # encryption type 1 key data?
             if (
@@ -347,17 +404,18 @@ class BookMobi(object):
                     raise Exception("exth header error: %s" % exthIdent)
                 offset += 12
                 count = 0
+                mv = memoryview(record0)
+                self.mobi_exth = ExthRecords(record0)
                 while count < exthCount:
-                    recordType, recordLength = struct.unpack_from(
-                        ">LL", record0, exth_addr + offset
-                    )
-                    (data,) = struct.unpack_from(
-                        "%ds" % (recordLength - 8), record0, exth_addr + offset + 8
-                    )
-                    self.mobi_exth[recordType] = data
+                    p = exth_addr + offset
+                    recordType = int.from_bytes(mv[p : p + 4], "big")
+                    recordLength = int.from_bytes(mv[p + 4 : p + 8], "big")
+                    self.mobi_exth.add(recordType, p + 8, recordLength - 8)
                     if DEBUG:
                         if not recordType in mobi_exth_type:
-                            print(recordType, data, "unknown type")
+                            print(
+                                recordType, self.mobi_exth[recordType], "unknown type"
+                            )
                     offset += recordLength
                     count += 1
             (title,) = struct.unpack_from(
@@ -405,11 +463,10 @@ class BookMobi(object):
             for c in range(1, self.mobi["huffmanRecordCount"]):
                 rec_cdic = self.loadRecord(self.mobi["huffmanRecordOffset"] + c)
                 self.compression.loadCdic(rec_cdic)
-        if sys.version_info[0] < 3:
-            unpack = self.compression.unpack
-        else:
-            unpack = self.compression.unpack3
-        return unpack
+            if self.compression.tables is not None:
+                # set up the phrase tables before unpack runs in many threads
+                self.compression.loadPhrases()
+        return self.compression.unpack
 
     def typeDesc(self, types, value):
         if value in types:
@@ -425,15 +482,33 @@ class BookMobi(object):
         """
         load palm database's record
         """
-        offset = self.records[record_index][0]
-        self.f.seek(offset)
+        offset = self.record_offsets[record_index]
         if record_index == (self.header["numberOfRecords"] - 1):
+            offset2 = None
+        else:
+            offset2 = self.record_offsets[record_index + 1]
+        if self.mm is not None:
+            return self.mm[offset:offset2]
+        self.f.seek(offset)
+        if offset2 is None:
             record = self.f.read()
         else:
-            offset2 = self.records[record_index + 1][0]
             record = self.f.read(offset2 - offset)
         return record
 
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.owns_file:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
     def datetimeFromValue(self, value):
         """
         If the time has the top bit set, it's an unsigned 32-bit number counting from 1st Jan 1904
@@ -447,19 +522,44 @@ class BookMobi(object):
         time += datetime.timedelta(seconds=value)
         return time
 
+    def loadTextRecord(self, record_index):
+        """
+        load text record without its trailing entries
+        """
+        record = self.loadRecord(record_index)
+        mv = memoryview(record)
+        end = len(record)
+        extraflags = self.mobi["extraRecordDataFlags"] >> 1
+        while extraflags & 0x1:
+            # the maximum length of trailing entries size is 32.
+            vint = int.from_bytes(mv[end - 4 : end], "big")
+            end -= decodeVarint(vint)
+            extraflags >>= 1
+        if self.mobi["extraRecordDataFlags"] & 0x1:
+            # multibyte bytes is the last byte at the end of trailing
+            # entries
+            # bit 1-2 is length, 3-8 is unknown. plus 1 size byte
+            end -= (mv[end - 1] & 0x3) + 1
+        record = record[:end]
+        if self.palmdoc["encryptionType"]:
+            record = self.decrypt(record)
+        return record
+
     def decrypt(self, record):
         return record
 
+    def progress(self, count):
+        # one dot per 64 records keeps stdout flushes off the hot loops
+        if count % 64 == 0:
+            sys.stdout.write(".")
+            sys.stdout.flush()
+
     def imageExt(self, record):
-        (ident,) = struct.unpack_from(">L", record, 0)
-        if ident == 0x47494638:
-            return ".gif"
-        elif ident == 0x89504E47:
-            return ".png"
-        ident = struct.unpack_from(">HHHL", record, 0)
-        if ident[3] == 0x4A464946:
+        ident = record[0:4]
+        if ident in image_magic:
+            return image_magic[ident]
+        if record[6:10] == b"JFIF":
             return ".jpg"
-        (ident,) = struct.unpack_from(">4s", record, 0)
         return ".%s" % ident
 
     def saveRecordImage(self, num, basename):
@@ -471,91 +571,118 @@ class BookMobi(object):
         return os.path.basename(img_file)
 
     def loadTextResource(self, data, basename):
-        def repl(mo):
-            img_idx = int(mo.group(1))
-            num = img_idx_base + img_idx - 1
-            img_basename = "%s_img_%05d" % (basename, img_idx)
-            sys.stdout.write(".")
-            sys.stdout.flush()
-            img_file = self.saveRecordImage(num, img_basename)
-            return toByte('<img src="%s"' % img_file)
-
         print("Dump image")
         img_idx_base = int(self.mobi["firstImageIndex"])
-        img_pattern = (
-            b"""<img\s+recindex=['"](\d+)['"]""",
-            b"""<img\s+src=['"]kindle:embed:(\d+)\?mime=image/jpg['"]""",
-        )
-        for pattern in img_pattern:
-            regex = re.compile(pattern, re.I)
-            data = regex.sub(repl, data)
+        spans = [
+            (mo.start(), mo.end(), int(mo.group("r") or mo.group("k")))
+            for mo in img_regex.finditer(data)
+        ]
+        # write every referenced image once, then splice the tags in one pass
+        img_tags = {}
+        for start, end, img_idx in spans:
+            if img_idx not in img_tags:
+                img_file = self.saveRecordImage(
+                    img_idx_base + img_idx - 1, "%s_img_%05d" % (basename, img_idx)
+                )
+                img_tags[img_idx] = toByte('<img src="%s"' % img_file)
+                self.progress(len(img_tags))
+        mv = memoryview(data)
+        out = bytearray()
+        last = 0
+        for start, end, img_idx in spans:
+            out += mv[last:start]
+            out += img_tags[img_idx]
+            last = end
+        out += mv[last:]
+        data = out
         if self.mobi["textEncoding"] == 65001:
             charset = "utf-8"
         else:
             charset = "cp%d" % self.mobi["textEncoding"]
-        data = re.sub(
-            b"<head>",
+        data = head_regex.sub(
             toByte(
                 '<head>\n<meta http-equiv="Content-Type" content="text/html; charset=%s" />'
                 % charset
             ),
             data,
-            re.I,
+            count=1,
         )
         print("")
         return data
 
+    def unpackTextRecords(self, unpack):
+        # yield the unpacked text records in order; the numba decoders
+        # release the GIL, so with them records are unpacked in parallel,
+        # at most 2 per worker ahead of the one being written
+        records = (
+            self.loadTextRecord(rn) for rn in range(1, self.palmdoc["recordCount"] + 1)
+        )
+        workers = 1
+        if compression.loadJit() and isinstance(
+            self.compression, (compression.Palmdoc, compression.Huffcdic)
+        ):
+            workers = self.workers or os.cpu_count() or 1
+        if workers == 1:
+            yield from map(unpack, records)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for record in records:
+                pending.append(executor.submit(unpack, record))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     def unpackMobi(self, output_file):
-        rec_num = self.palmdoc["recordCount"]
         text_length = self.palmdoc["textLength"]
         unpack = self.unpackFunction()
-        data = []
+        basename = os.path.splitext(output_file)[0]
+        css_filename = "%s.css" % basename
+        css_file = None
+        written = 0
         print("Title: %s" % self.book["title"])
         print("Compression Type: %s" % self.book["compression"])
         print("Encryption Type: %s" % self.book["encryption"])
         print("Dump html/css")
-        for rn in range(1, rec_num + 1):
-            record = self.loadRecord(rn)
-            extraflags = self.mobi["extraRecordDataFlags"] >> 1
-            while extraflags & 0x1:
-                # the maximum length of trailing entries size is 32.
-                (vint,) = struct.unpack_from(">L", record[-4:], 0)
-                fint = decodeVarint(vint)
-                record = record[:-fint]
-                extraflags >>= 1
-            if self.mobi["extraRecordDataFlags"] & 0x1:
-                # multibyte bytes is the last byte at the end of trailing
-                # entries
-                (mb_num,) = struct.unpack_from(">B", record[-1:], 0)
-                # bit 1-2 is length, 3-8 is unknown. plus 1 size byte
-                mb_num = (mb_num & 0x3) + 1
-                record = record[:-mb_num]
-            record = self.decrypt(record)
-            sys.stdout.write(".")
-            sys.stdout.flush()
-            data.append(unpack(record))
-        data_text = b"".join(data)
-        data_css = data_text[text_length:]
-        data_text = data_text[:text_length]
+        html_file = open(output_file, "wb")
+        try:
+            for rn, chunk in enumerate(self.unpackTextRecords(unpack), 1):
+                self.progress(rn)
+                # split the decoded stream at text_length: html, then css
+                chunk = memoryview(chunk)
+                split = max(text_length - written, 0)
+                if split:
+                    html_file.write(chunk[:split])
+                if split < len(chunk):
+                    if css_file is None:
+                        css_file = open(css_filename, "wb")
+                    css_file.write(chunk[split:])
+                written += len(chunk)
+        finally:
+            html_file.close()
+            if css_file is not None:
+                css_file.close()
         sys.stdout.write("html: %d" % text_length)
-        basename = os.path.splitext(output_file)[0]
-        if data_css:
-            sys.stdout.write(" / css: %d" % len(data_css))
-            css_filename = "%s.css" % basename
-            with open(css_filename, "wb") as f:
-                f.write(data_css)
-            data_text = re.sub(
-                r"""<head>""",
-                '<head>\n<link rel="stylesheet" href="%s" type="text/css"/>'
-                % os.path.basename(css_filename),
-                data_text,
-                re.I,
-            )
+        if css_file is not None:
+            sys.stdout.write(" / css: %d" % (written - text_length))
         print("")
-        if self.mobi["firstImageIndex"] != 0xFFFFFFFF:
-            data_text = self.loadTextResource(data_text, basename)
-        with open(output_file, "wb") as f:
-            f.write(data_text)
+        if css_file is not None or self.mobi["firstImageIndex"] != 0xFFFFFFFF:
+            with open(output_file, "rb") as f:
+                data_text = f.read()
+            if css_file is not None:
+                data_text = head_regex.sub(
+                    toByte(
+                        '<head>\n<link rel="stylesheet" href="%s" type="text/css"/>'
+                        % os.path.basename(css_filename)
+                    ),
+                    data_text,
+                    count=1,
+                )
+            if self.mobi["firstImageIndex"] != 0xFFFFFFFF:
+                data_text = self.loadTextResource(data_text, basename)
+            with open(output_file, "wb") as f:
+                f.write(data_text)
         # cover
         if 201 in self.mobi_exth:
             print("Dump cover")
@@ -584,8 +711,7 @@ class BookMobi(object):
             print("Output ZIP file: %s " % outsrcs)
             f = open(outsrcs, "wb")
             for rn in range(srcs_rn, srcs_rn + srcs_rc):
-                sys.stdout.write(".")
-                sys.stdout.flush()
+                self.progress(rn)
                 rec = self.loadRecord(rn)
                 header = struct.unpack_from(">4L", rec, 0)
                 if header[0] == 0x53524353:
@@ -598,50 +724,51 @@ class BookMobi(object):
             self.f.seek(0)
             f.write(self.f.read(78))
             # replace srcs section with 2-zero bytes
-            recordlist_data = array.array(
-                "B", self.f.read(8 * self.header["numberOfRecords"])
-            )
+            recordlist_data = bytearray(self.f.read(8 * self.header["numberOfRecords"]))
+
+            def fix_offsets(first, offsets):
+                # rewrite the offset half of each 8-byte record info entry
+                u_fmt = ">%dL" % (2 * len(offsets))
+                entries = list(struct.unpack_from(u_fmt, recordlist_data, first * 8))
+                entries[0::2] = offsets
+                struct.pack_into(u_fmt, recordlist_data, first * 8, *entries)
+
             print("Fix record offset")
-            srcs_offset = self.records[srcs_rn][0]
-            for count in range(0, srcs_rc):
-                sys.stdout.write(".")
-                sys.stdout.flush()
-                fix_offset = srcs_offset + count * 2
-                struct.pack_into(
-                    ">L", recordlist_data, (srcs_rn + count) * 8, fix_offset
-                )
-            offset = self.records[srcs_rn + srcs_rc][0] - srcs_offset - srcs_rc * 2
-            for rn in range(srcs_rn + srcs_rc, self.header["numberOfRecords"]):
-                sys.stdout.write(".")
-                sys.stdout.flush()
-                fix_offset = self.records[rn][0] - offset
-                struct.pack_into(">L", recordlist_data, rn * 8, fix_offset)
+            srcs_offset = self.record_offsets[srcs_rn]
+            fix_offsets(
+                srcs_rn, [srcs_offset + count * 2 for count in range(0, srcs_rc)]
+            )
+            offset = self.record_offsets[srcs_rn + srcs_rc] - srcs_offset - srcs_rc * 2
+            fix_offsets(
+                srcs_rn + srcs_rc,
+                [
+                    self.record_offsets[rn] - offset
+                    for rn in range(srcs_rn + srcs_rc, self.header["numberOfRecords"])
+                ],
+            )
             f.write(recordlist_data)
             print("")
             # gap
-            gapToDataLength = self.records[0][0] - f.tell()
+            gapToDataLength = self.record_offsets[0] - f.tell()
             if gapToDataLength:
                 f.write(self.f.read(gapToDataLength))
             # record
             print("Write record")
-            record0 = array.array("B", self.loadRecord(0))
+            record0 = bytearray(self.loadRecord(0))
             struct.pack_into(">LL", record0, 224, 0xFFFFFFFF, 0)
             f.write(record0)
             for rn in range(1, srcs_rn):
-                sys.stdout.write(".")
-                sys.stdout.flush()
+                self.progress(rn)
                 rec = self.loadRecord(rn)
                 f.write(rec)
             srcs_data = b"\x00\x00"
             # srcs record
             for rn in range(srcs_rn, srcs_rn + srcs_rc):
-                sys.stdout.write(".")
-                sys.stdout.flush()
+                self.progress(rn)
                 f.write(srcs_data)
             # record
             for rn in range(srcs_rn + srcs_rc, self.header["numberOfRecords"]):
-                sys.stdout.write(".")
-                sys.stdout.flush()
+                self.progress(rn)
                 rec = self.loadRecord(rn)
                 f.write(rec)
             print("")
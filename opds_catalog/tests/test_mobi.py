@@ -0,0 +1,294 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+
+from django.test import TestCase
+
+from book_tools.pymobi import compression
+from book_tools.pymobi.mobi import BookMobi
+
+
+def palmdoc_copy(distance, length):
+    return struct.pack(">H", 0x8000 | distance << 3 | length - 3)
+
+
+# the test huffman code: phrases 0..239 have 8-bit terminal codes 255 - r,
+# phrases from 240 on have 16-bit codes huff_m16 - r starting with a 0x0?
+# byte, which dict1 marks non-terminal, so they are found by walking mincode
+huff_m16 = 0x0FFF + 240
+
+
+def huff_record(nonterminal_maxcode=0):
+    # maxcode of a non-terminal dict1 entry is never used by the decoders
+    dict1 = [
+        0xFF << 8 | 0x80 | 8 if t >= 0x10 else nonterminal_maxcode << 8 | 9
+        for t in range(256)
+    ]
+    dict2 = []
+    for codelen in range(1, 33):
+        if codelen == 8:
+            dict2 += [0x10, 0xFF]
+        elif codelen == 16:
+            dict2 += [0, huff_m16]
+        elif 9 <= codelen <= 15:
+            dict2 += [(1 << codelen) - 1, 0]
+        else:
+            dict2 += [0, 0]
+    return (
+        b"HUFF\x00\x00\x00\x18"
+        + struct.pack(">LL", 24, 24 + 1024)
+        + b"\x00" * 8
+        + struct.pack(">256L", *dict1)
+        + struct.pack(">64L", *dict2)
+    )
+
+
+def cdic_record(phrases):
+    # phrases are (data, literal) pairs, all of them in a single record
+    offsets, body = [], b""
+    for data, literal in phrases:
+        offsets.append(2 * len(phrases) + len(body))
+        body += struct.pack(">H", len(data) | (0x8000 if literal else 0)) + data
+    return (
+        b"CDIC\x00\x00\x00\x10"
+        + struct.pack(">LL", len(phrases), 12)
+        + struct.pack(">%dH" % len(phrases), *offsets)
+        + body
+    )
+
+
+def huff_encode(symbols):
+    bits, nbits = 0, 0
+    for r in symbols:
+        if r < 240:
+            bits, nbits = (bits << 8) | (255 - r), nbits + 8
+        else:
+            bits, nbits = (bits << 16) | (huff_m16 - r), nbits + 16
+    return bits.to_bytes(nbits // 8, "big")
+
+
+def huffcdic(phrases):
+    c = compression.Huffcdic()
+    c.loadHuff(huff_record())
+    c.loadCdic(cdic_record(phrases))
+    return c
+
+
+def huff_compress(data, phrases):
+    # greedy longest match over the phrases that can be expanded
+    c = huffcdic(phrases)
+    lookup = {}
+    for r in range(240, len(phrases)):
+        try:
+            lookup[c.unpackPython(huff_encode([r]))] = r
+        except ValueError:
+            pass
+    longest = max(map(len, lookup))
+    symbols, p = [], 0
+    while p < len(data):
+        for size in range(min(longest, len(data) - p), 0, -1):
+            if data[p : p + size] in lookup:
+                symbols.append(lookup[data[p : p + size]])
+                p += size
+                break
+        else:
+            symbols.append(data[p])
+            p += 1
+    return huff_encode(symbols)
+
+
+def mobi_book(title, author, text, text_length, images=(), huff_phrases=None):
+    # BOOKMOBI file: record0, 4096 byte text records, images, huff/cdic;
+    # the text is stored uncompressed unless huff_phrases are given
+    records = [text[p : p + 4096] for p in range(0, len(text), 4096)]
+    compression_type = 1
+    if huff_phrases is not None:
+        compression_type = 17480
+        records = [huff_compress(record, huff_phrases) for record in records]
+    first_image = len(records) + 1 if images else 0xFFFFFFFF
+    exth = struct.pack(">LL", 100, 8 + len(author)) + author
+    exth = b"EXTH" + struct.pack(">LL", 12 + len(exth), 1) + exth
+    record0 = bytearray(16 + 0xE8)
+    struct.pack_into(
+        ">HHLHHHH",
+        record0,
+        0,
+        compression_type,
+        0,
+        text_length,
+        len(records),
+        4096,
+        0,
+        0,
+    )
+    struct.pack_into(">4sLLL", record0, 16, b"MOBI", 0xE8, 2, 65001)
+    struct.pack_into(">L", record0, 80, len(records) + 1)
+    struct.pack_into(">LL", record0, 84, len(record0) + len(exth), len(title))
+    struct.pack_into(">LL", record0, 104, 6, first_image)
+    struct.pack_into(">L", record0, 128, 0x40)
+    struct.pack_into(">L", record0, 168, 0xFFFFFFFF)
+    struct.pack_into(">L", record0, 224, 0xFFFFFFFF)
+    if huff_phrases is not None:
+        huff = [huff_record(), cdic_record(huff_phrases)]
+        struct.pack_into(">LL", record0, 112, 1 + len(records) + len(images), 2)
+    else:
+        huff = []
+    records = [bytes(record0) + exth + title] + records + list(images) + huff
+    header = bytearray(78)
+    struct.pack_into("32s", header, 0, title)
+    struct.pack_into("4s4s", header, 60, b"BOOK", b"MOBI")
+    struct.pack_into(">H", header, 76, len(records))
+    offset = 78 + 8 * len(records) + 2
+    for n, record in enumerate(records):
+        header += struct.pack(">LL", offset, 2 * n)
+        offset += len(record)
+    return bytes(header) + b"\x00\x00" + b"".join(records)
+
+
+class mobiTestCase(TestCase):
+    test_module_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    test_ROOTLIB = os.path.join(test_module_path, "tests/data")
+    test_mobi = "robin_cook.mobi"
+
+    # 240: literal, 241 and 242: nested compressed phrases,
+    # 243: refers to itself, 244 and 245: refer to each other
+    huff_phrases = [(bytes([r]), True) for r in range(240)] + [
+        (b"HUFF ", True),
+        (huff_encode(b"ab"), False),
+        (huff_encode([241, 240, ord("!")]), False),
+        (huff_encode([243]), False),
+        (huff_encode([245]), False),
+        (huff_encode([244]), False),
+    ]
+    huff_text = huff_encode([ord("x"), 242, 240, 241, ord("y")])
+
+    def test_huffcdic_unpack(self):
+        """Тестирование класса Huffcdic - распаковка вложенных фраз"""
+        expected = b"xabHUFF !HUFF aby"
+        self.assertEquals(huffcdic(self.huff_phrases).unpack(self.huff_text), expected)
+        self.assertEquals(
+            huffcdic(self.huff_phrases).unpackPython(self.huff_text), expected
+        )
+        # the decoded and stored phrases are reused
+        c = huffcdic(self.huff_phrases)
+        self.assertEquals(c.unpack(self.huff_text * 2), expected * 2)
+        self.assertEquals(c.unpack(self.huff_text), expected)
+
+    def test_huffcdic_nonterminal_maxcode(self):
+        """Тестирование класса Huffcdic - большой maxcode нетерминального кода"""
+        c = compression.Huffcdic()
+        c.loadHuff(huff_record(0xFFFFFF))
+        c.loadCdic(cdic_record(self.huff_phrases))
+        self.assertEquals(c.unpack(self.huff_text), b"xabHUFF !HUFF aby")
+
+    def test_huffcdic_recursive(self):
+        """Тестирование класса Huffcdic - фраза, ссылающаяся на себя"""
+        for r in (243, 244):
+            text = huff_encode([ord("x"), r])
+            with self.assertRaises(ValueError):
+                huffcdic(self.huff_phrases).unpack(text)
+            with self.assertRaises(ValueError):
+                huffcdic(self.huff_phrases).unpackPython(text)
+
+    def test_huffcdic_deep_chain(self):
+        """Тестирование класса Huffcdic - цепочка из 1500 вложенных фраз"""
+        # phrase 240 + k refers to 241 + k, deeper than the recursion limit
+        chain = [(huff_encode([r + 1, ord("-")]), False) for r in range(240, 1739)]
+        phrases = self.huff_phrases[:240] + chain + [(b"end", True)]
+        text = huff_encode([ord("x"), 240])
+        expected = b"xend" + b"-" * 1499
+        self.assertEquals(huffcdic(phrases).unpack(text), expected)
+        self.assertEquals(huffcdic(phrases).unpackPython(text), expected)
+        # the last phrase refers back to the first one
+        phrases[-1] = (huff_encode([240]), False)
+        with self.assertRaises(ValueError):
+            huffcdic(phrases).unpack(text)
+        with self.assertRaises(ValueError):
+            huffcdic(phrases).unpackPython(text)
+
+    def test_huffcdic_workers(self):
+        """Тестирование класса BookMobi - HUFF/CDIC в несколько потоков"""
+        text = b"xabHUFF !y, HUFF zab. " * 15000
+        book = mobi_book(
+            b"Huff", b"Author", text, len(text), huff_phrases=self.huff_phrases
+        )
+        with BookMobi(io.BytesIO(book)) as bm:
+            bm.workers = 4
+            chunks = list(bm.unpackTextRecords(bm.unpackFunction()))
+            c = huffcdic(self.huff_phrases)
+            expected = [
+                c.unpackPython(bm.loadTextRecord(rn))
+                for rn in range(1, bm.palmdoc["recordCount"] + 1)
+            ]
+        self.assertEquals(len(chunks), 81)
+        self.assertEquals(chunks, expected)
+        self.assertEquals(b"".join(chunks), text)
+
+    def test_palmdoc_unpack(self):
+        """Тестирование класса Palmdoc - распаковка всех видов команд"""
+        data = (
+            b"\x04abcd"  # literal run
+            + palmdoc_copy(4, 4)  # back-reference as long as its distance
+            + b"x"
+            + palmdoc_copy(1, 6)  # overlapping back-reference
+            + b"\xe8"  # space pair
+            + palmdoc_copy(10, 3)
+        )
+        expected = b"abcdabcdxxxxxxx hdxx"
+        self.assertEquals(compression.Palmdoc().unpack(data), expected)
+        self.assertEquals(compression.Palmdoc().unpackPython(data), expected)
+
+    def test_palmdoc_truncated(self):
+        """Тестирование класса Palmdoc - обрезанные и неверные данные"""
+        for data, expected in ((b"ab\x05cd", b"abcd"), (b"ab\x80", b"ab")):
+            self.assertEquals(compression.Palmdoc().unpack(data), expected)
+            self.assertEquals(compression.Palmdoc().unpackPython(data), expected)
+        for data in (b"ab" + palmdoc_copy(3, 3), b"ab" + palmdoc_copy(0, 3)):
+            with self.assertRaises(ValueError):
+                compression.Palmdoc().unpack(data)
+            with self.assertRaises(ValueError):
+                compression.Palmdoc().unpackPython(data)
+
+    def test_unpackmobi_head(self):
+        """Тестирование класса BookMobi - css и картинки при теге <HEAD>"""
+        html = b'<HTML><HEAD><TITLE>x</TITLE></HEAD><BODY><img recindex="00001">'
+        html += b"<P>" + b"text " * 2000 + b"</P></BODY></HTML>"
+        css = b"p { margin: 0 }"
+        image = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\x00" * 16
+        book = mobi_book(b"Head", b"Author", html + css, len(html), [image])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with BookMobi(io.BytesIO(book)) as bm:
+                bm.unpackMobi(os.path.join(tmp_dir, "book.html"))
+            with open(os.path.join(tmp_dir, "book.html"), "rb") as f:
+                data = f.read()
+            with open(os.path.join(tmp_dir, "book.css"), "rb") as f:
+                self.assertEquals(f.read(), css)
+            with open(os.path.join(tmp_dir, "book_img_00001.jpg"), "rb") as f:
+                self.assertEquals(f.read(), image)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEquals(data.count(b"<meta "), 1)
+        self.assertEquals(data.count(b"<link "), 1)
+        self.assertEquals(data.lower().count(b"<head>"), 1)
+        self.assertIn(b'<img src="book_img_00001.jpg">', data)
+        self.assertTrue(data.endswith(b"</P></BODY></HTML>"))
+
+    def test_bookmobi_instances(self):
+        """Тестирование класса BookMobi - две книги не делят состояние"""
+        book = mobi_book(b"Second", b"Author", b"<html></html>", 13)
+        with BookMobi(os.path.join(self.test_ROOTLIB, self.test_mobi)) as first:
+            with BookMobi(io.BytesIO(book)) as second:
+                self.assertIsNot(first.book, second.book)
+                self.assertIsNot(first.mobi, second.mobi)
+                self.assertIsNot(first.palmdoc, second.palmdoc)
+                self.assertEquals(first["title"], "Vector")
+                self.assertEquals(second["title"], "Second")
+                self.assertEquals(second["author"], "Author")
+                self.assertNotEquals(first["author"], "Author")
+                self.assertEquals(second.mobi["firstImageIndex"], 0xFFFFFFFF)
+                self.assertNotEquals(first.mobi["firstImageIndex"], 0xFFFFFFFF)
+                second.book["title"] = "Changed"
+                self.assertEquals(first["title"], "Vector")